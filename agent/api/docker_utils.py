@@ -91,8 +91,10 @@ async def wait_for_healthy_containers(
     container_names: List[str],
     container_types: List[str],
     timeout: int = 30,
-    interval: int = 1
+    interval: float = 1,
+    max_interval: Optional[float] = None
 ) -> bool:
+    # with max_interval set, the poll interval doubles after each miss up to that cap
     docker_cli = docker.from_env()
     start_time = anyio.current_time()
 
@@ -127,6 +129,8 @@ async def wait_for_healthy_containers(
                 return True
 
             await anyio.sleep(interval)
+            if max_interval is not None:
+                interval = min(interval * 2, max_interval)
 
         logger.error(f"Containers did not become healthy within {timeout} seconds")
         return False
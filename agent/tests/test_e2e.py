@@ -1,5 +1,7 @@
 import os
+import sys
 import pytest
+import shutil
 import tempfile
 import anyio
 import contextlib
@@ -16,13 +18,32 @@ logger = get_logger(__name__)
 pytestmark = pytest.mark.anyio
 
 
+# uvloop is only installed off Windows, see pyproject.toml
+USE_UVLOOP = sys.platform != "win32"
+
+# upper bound on "just do it" follow-ups before the run is failed
+MAX_REFINEMENTS = 3
+
+# keep app checkouts in RAM when /dev/shm has at least this much free space
+MIN_SHM_FREE_BYTES = 1 << 30
+
+
+def e2e_tmp_dir() -> str | None:
+    """Base directory for e2e app checkouts: AGENT_TMPDIR if set, else /dev/shm when it has room"""
+    if tmp_dir := os.environ.get("AGENT_TMPDIR"):
+        return tmp_dir
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= MIN_SHM_FREE_BYTES:
+        return "/dev/shm"
+    return None  # default temp location
+
+
 @contextlib.contextmanager
 def empty_context():
     yield
 
 @pytest.fixture
 def anyio_backend():
-    return 'asyncio'
+    return ('asyncio', {'use_uvloop': USE_UVLOOP})
 
 def latest_app_name_and_commit_message(events):
     """Extract the most recent app_name and commit_message from events"""
@@ -30,21 +51,18 @@ def latest_app_name_and_commit_message(events):
     commit_message = None
 
     for evt in reversed(events):
-        try:
-            if evt.message:
-                # Update app_name if found and not yet set
-                if app_name is None and evt.message.app_name is not None:
-                    app_name = evt.message.app_name
-
-                # Update commit_message if found and not yet set
-                if commit_message is None and evt.message.commit_message is not None:
-                    commit_message = evt.message.commit_message
-
-                # If both are set, we can break
-                if app_name is not None and commit_message is not None:
-                    break
-        except AttributeError:
+        message = getattr(evt, "message", None)
+        if not message:
             continue
+        # Update app_name / commit_message if found and not yet set
+        if app_name is None:
+            app_name = getattr(message, "app_name", None)
+        if commit_message is None:
+            commit_message = getattr(message, "commit_message", None)
+
+        # If both are set, we can break
+        if app_name is not None and commit_message is not None:
+            break
 
     return app_name, commit_message
 
@@ -54,7 +72,12 @@ async def run_e2e(prompt: str, standalone: bool, with_edit=True, template_id=Non
         async with AgentApiClient() as client:
             events, request = await client.send_message(prompt, template_id=template_id)
             assert events, "No response received from agent"
+            # all follow-ups reuse the single client session opened above; do not re-enter
+            # AgentApiClient per iteration, that would drop the pooled connection
+            refinements = 0
             while events[-1].message.kind == MessageKind.REFINEMENT_REQUEST:
+                refinements += 1
+                assert refinements <= MAX_REFINEMENTS, f"Agent still asking for refinement after {MAX_REFINEMENTS} follow-ups"
                 events, request = await client.continue_conversation(
                     previous_events=events,
                     previous_request=request,
@@ -85,7 +108,7 @@ async def run_e2e(prompt: str, standalone: bool, with_edit=True, template_id=Non
             else:
                 updated_diff = diff
 
-            with tempfile.TemporaryDirectory() as temp_dir:
+            with tempfile.TemporaryDirectory(dir=e2e_tmp_dir()) as temp_dir:
                 # Determine template path based on template_id
                 template_paths = {
                     "nicegui_agent": "nicegui_agent/template",
@@ -93,16 +116,16 @@ async def run_e2e(prompt: str, standalone: bool, with_edit=True, template_id=Non
                     None: "trpc_agent/template"  # default
                 }
 
-                for d in (diff, updated_diff):
+                # the edit diff is incremental against the first run's files, so apply both in order;
+                # without an edit updated_diff is diff itself and applying it again is redundant
+                for d in ((diff, updated_diff) if with_edit else (diff,)):
                     success, message = apply_patch(d, temp_dir, template_paths[template_id])
                     assert success, f"Failed to apply patch: {message}"
 
-                original_dir = os.getcwd()
                 container_names = setup_docker_env()
 
                 try:
-                    os.chdir(temp_dir)
-
+                    # compose commands run with cwd=temp_dir, no process-wide chdir needed
                     success, error_message = start_docker_compose(temp_dir, container_names["project_name"])
                     if not success:
                         # Get logs if possible for debugging
@@ -126,7 +149,8 @@ async def run_e2e(prompt: str, standalone: bool, with_edit=True, template_id=Non
                         ],
                         ["db", "app"],
                         timeout=30,
-                        interval=1
+                        interval=0.25,
+                        max_interval=2,
                     )
 
                     if not container_healthy:
@@ -137,9 +161,6 @@ async def run_e2e(prompt: str, standalone: bool, with_edit=True, template_id=Non
                         print("🧹Tearing down containers... ")
 
                 finally:
-                    # Restore original directory
-                    os.chdir(original_dir)
-
                     # Clean up Docker containers
                     stop_docker_compose(temp_dir, container_names["project_name"])
 
@@ -161,7 +182,7 @@ def create_app(prompt):
     import coloredlogs
 
     coloredlogs.install(level="INFO")
-    anyio.run(run_e2e, prompt, True)
+    anyio.run(run_e2e, prompt, True, backend="asyncio", backend_options={"use_uvloop": USE_UVLOOP})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import tempfile
+import anyio
+import pytest
+from core.actors import BaseData
+from core.base_node import Node
+from core.statemachine import State, StateMachine
+from trpc_agent.application import ApplicationContext, FSMApplication, FSMEvent, _update_node_files, _write_files
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+def test_fsm_event_eq_with_str_and_event():
+    confirm = FSMEvent("CONFIRM")
+    assert confirm == "CONFIRM"
+    assert confirm == FSMEvent("CONFIRM", feedback="ignored")
+    assert confirm != "FEEDBACK"
+    assert confirm != FSMEvent("FEEDBACK")
+
+
+def test_fsm_event_eq_with_unsupported_type():
+    # __eq__ returns NotImplemented, so Python falls back to identity instead of raising
+    assert (FSMEvent("CONFIRM") == 1) is False
+    assert FSMEvent("CONFIRM") != None  # noqa: E711
+
+
+@pytest.mark.parametrize("type_", ["CONFIRM", "FEEDBACK"])
+def test_fsm_event_hash_consistent_with_eq(type_):
+    event = FSMEvent(type_)
+    assert hash(event) == hash(type_) == hash(FSMEvent(type_, feedback="x"))
+    transitions = {event: "target"}
+    assert transitions[type_] == "target"
+    assert transitions[FSMEvent(type_)] == "target"
+
+
+def test_write_files_creates_nested_paths(tmp_path):
+    _write_files(str(tmp_path / "layer"), {"a.txt": "a", "client/src/App.tsx": "app\r\n"})
+    assert (tmp_path / "layer" / "a.txt").read_text() == "a"
+    assert (tmp_path / "layer" / "client" / "src" / "App.tsx").read_bytes() == b"app\r\n"
+
+
+def test_write_files_raises_on_escaping_path(tmp_path):
+    with pytest.raises(ValueError):
+        _write_files(str(tmp_path / "layer"), {"ok.txt": "ok", "../outside.txt": "nope"})
+    assert not (tmp_path / "outside.txt").exists()
+
+
+class _HangingHost:
+    def directory(self, path):
+        return self
+
+    async def sync(self):
+        await anyio.sleep_forever()
+
+
+class _HangingClient:
+    def host(self):
+        return _HangingHost()
+
+
+@pytest.mark.anyio
+async def test_files_directories_cleans_up_when_cancelled(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    fsm_app = FSMApplication(_HangingClient(), None)  # pyright: ignore[reportArgumentType]
+    with anyio.move_on_after(0.1):
+        await fsm_app._files_directories({"a.txt": "a"}, {"b/c.txt": "c"})
+    assert list(tmp_path.iterdir()) == []
+
+
+class _LocalOnlyClient:
+    """Client stand-in for code paths that fail before reaching the Dagger engine"""
+
+    def directory(self):
+        return self
+
+    def with_file(self, path, file):
+        return self
+
+    def host(self):
+        return self
+
+    def file(self, path):
+        return None
+
+
+@pytest.mark.anyio
+async def test_get_diff_with_reports_upload_errors():
+    fsm = StateMachine[ApplicationContext, FSMEvent](State(), ApplicationContext(user_prompt="test"))
+    fsm_app = FSMApplication(_LocalOnlyClient(), fsm)  # pyright: ignore[reportArgumentType]
+    diff_result = await fsm_app.get_diff_with({"../outside.txt": "nope"})
+    assert diff_result.startswith("# ERROR GENERATING DIFF")
+    assert "outside.txt" in diff_result
+
+
+@pytest.mark.anyio
+async def test_update_node_files_invalidates_truncated_files_cache():
+    ctx = ApplicationContext(user_prompt="test", files={"a.txt": "a", "big.txt": "x" * 300})
+    fsm_app = FSMApplication(_LocalOnlyClient(), StateMachine[ApplicationContext, FSMEvent](State(), ctx))  # pyright: ignore[reportArgumentType]
+    before = fsm_app.truncated_files
+    assert before == {"a.txt": "a", "big.txt": "large file truncated"}
+    assert fsm_app.truncated_files is before
+
+    root = Node(BaseData(None, [], {"a.txt": "a2", "big.txt": "small"}))  # pyright: ignore[reportArgumentType]
+    await _update_node_files(ctx, Node(BaseData(None, [], {"b.txt": "b"}), parent=root))  # pyright: ignore[reportArgumentType]
+    assert fsm_app.truncated_files == {"a.txt": "a2", "big.txt": "small", "b.txt": "b"}
+
+    await _update_node_files(ctx, {"c": Node(BaseData(None, [], {"c.txt": "c"}))})  # pyright: ignore[reportArgumentType]
+    assert fsm_app.truncated_files == {"a.txt": "a2", "big.txt": "small", "b.txt": "b", "c.txt": "c"}
@@ -1,15 +1,20 @@
 import os
+import sys
 import anyio
+import anyio.to_thread
+import shutil
+import tempfile
+import weakref
 import logging
 import enum
-from typing import Dict, Self, Optional, Literal, Any
+from typing import ClassVar, Dict, Self, Optional, Literal, Any
 from dataclasses import dataclass, field
 from core.statemachine import StateMachine, State, Context
 from llm.utils import get_vision_llm_client, get_best_coding_llm_client
 from core.actors import BaseData
 from core.base_node import Node
 from core.statemachine import MachineCheckpoint
-from core.workspace import Workspace
+from core.workspace import Workspace, retry_transport_errors
 from trpc_agent.diff_edit_actor import EditActor
 from trpc_agent.actors import DraftActor, HandlersActor, FrontendActor, ConcurrentActor
 import dagger
@@ -22,6 +27,37 @@ for package in ['urllib3', 'httpx', 'google_genai.models']:
     logging.getLogger(package).setLevel(logging.WARNING)
 
 
+def _write_files(root: str, files: dict[str, str]) -> None:
+    """Write files into a local directory, creating parent directories as needed.
+
+    Raises on the first file that cannot be written, so callers never upload a partial tree.
+    """
+    base = os.path.realpath(root)
+    os.makedirs(base, exist_ok=True)
+    for path, contents in files.items():
+        target = os.path.realpath(os.path.join(base, path))
+        if os.path.commonpath([base, target]) != base:
+            raise ValueError(f"File path resolves outside of target directory: {path}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "w", encoding="utf-8", newline="") as f:
+            f.write(contents)
+    logger.debug("Wrote %d files to local directory", len(files))
+
+
+# template directory handles keyed by id(client); the weakref evicts entries of closed clients
+_template_dirs: dict[int, tuple[weakref.ref, dagger.Directory]] = {}
+
+
+def _template_directory(client: dagger.Client) -> dagger.Directory:
+    key = id(client)
+    cached = _template_dirs.get(key)
+    if cached is not None and cached[0]() is client:
+        return cached[1]
+    directory = client.host().directory(FSMApplication.template_path())
+    _template_dirs[key] = (weakref.ref(client, lambda _: _template_dirs.pop(key, None)), directory)
+    return directory
+
+
 class FSMState(str, enum.Enum):
     DRAFT = "draft"
     REVIEW_DRAFT = "review_draft"
@@ -36,34 +72,47 @@ class FSMState(str, enum.Enum):
 class FSMEvent:
     type_: Literal["CONFIRM", "FEEDBACK"]
     feedback: Optional[str] = None
+    _hash: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # frozen dataclass, so bypass __setattr__ to cache the hash once
+        object.__setattr__(self, "_hash", hash(self.type_))
 
     def __eq__(self, other):
-        match other:
-            case FSMEvent():
-                return self.type_ == other.type_
-            case str():
-                return self.type_ == other
-            case _:
-                raise TypeError(f"Cannot compare FSMEvent with {type(other)}")
+        t = type(other)
+        if t is FSMEvent:
+            return self.type_ == other.type_
+        if t is str:
+            return self.type_ == other
+        return NotImplemented
 
     def __hash__(self):
-        return hash(self.type_)
+        return self._hash
 
     def __str__(self):
         return self.type_
 
 
-@dataclass
+_CONFIRM_EVENT = FSMEvent("CONFIRM") # frozen, safe to share across sends
+_FEEDBACK_EVENT = FSMEvent("FEEDBACK")
+_TERMINAL_STATES = frozenset({FSMState.COMPLETE, FSMState.FAILURE})
+
+
+@dataclass(slots=True)
 class ApplicationContext(Context):
     """Context for the fullstack application state machine"""
+    _FIELDS: ClassVar[frozenset[str]] = frozenset({"user_prompt", "feedback_data", "files", "error"})
+
     user_prompt: str
     feedback_data: Optional[str] = None
     files: Dict[str, str] = field(default_factory=dict)
     error: Optional[str] = None
 
     def dump(self) -> dict:
-        """Dump context to a serializable dictionary"""
-        # Convert dataclass to dictionary
+        """Dump context to a serializable dictionary.
+
+        `files` is returned by reference, callers must copy it before mutating.
+        """
         data = {
             "user_prompt": self.user_prompt,
             "feedback_data":self.feedback_data,
@@ -77,14 +126,42 @@ class ApplicationContext(Context):
         """Load context from a serializable dictionary"""
         if not isinstance(data, dict):
             raise ValueError(f"Invalid data type: {type(data)}")
+        if unknown := data.keys() - cls._FIELDS:
+            raise ValueError(f"Unknown context fields: {sorted(unknown)}")
         return cls(**data)
 
 
+def _agg_node_files(solution: Node[BaseData]) -> dict[str, str]:
+    files: dict[str, str] = {}
+    for node in solution.get_trajectory():
+        for k, v in node.data.files.items():
+            if v is None:
+                files.pop(k, None) # a later None drops the file, as the two-pass filter did
+            else:
+                files[k] = v
+    return files
+
+
+async def _update_node_files(ctx: ApplicationContext, result: Node[BaseData] | Dict[str, Node[BaseData]]) -> None:
+    logger.info("Updating context files from result")
+    # rebind instead of updating in place so identity-keyed caches see the change
+    if isinstance(result, Node):
+        ctx.files = {**ctx.files, **_agg_node_files(result)}
+    elif isinstance(result, dict):
+        files = dict(ctx.files)
+        for node in result.values():
+            files.update(_agg_node_files(node))
+        ctx.files = files
+
+
 class FSMApplication:
 
     def __init__(self, client: dagger.Client, fsm: StateMachine[ApplicationContext, FSMEvent]):
         self.fsm = fsm
         self.client = client
+        # host handle is resolved once and reused by every get_diff_with call
+        self._gitignore_file: dagger.File | None = None
+        self._truncated_files_cache: tuple[dict[str, str], dict[str, str]] | None = None
 
     @classmethod
     async def load(cls, client: dagger.Client, data: MachineCheckpoint, settings: Dict[str, Any] | None = None) -> Self:
@@ -111,26 +188,11 @@ class FSMApplication:
         states = await cls.make_states(client, settings)
         context = ApplicationContext(user_prompt=user_prompt)
         fsm = StateMachine[ApplicationContext, FSMEvent](states, context)
-        await fsm.send(FSMEvent("CONFIRM")) # confirm running first stage immediately
+        await fsm.send(_CONFIRM_EVENT) # confirm running first stage immediately
         return cls(client, fsm)
 
     @classmethod
     async def make_states(cls, client: dagger.Client, settings: Dict[str, Any] | None = None) -> State[ApplicationContext, FSMEvent]:
-        def agg_node_files(solution: Node[BaseData]) -> dict[str, str]:
-            files = {}
-            for node in solution.get_trajectory():
-                files.update(node.data.files)
-            return {k: v for k, v in files.items() if v is not None}
-
-        # Define actions to update context
-        async def update_node_files(ctx: ApplicationContext, result: Node[BaseData] | Dict[str, Node[BaseData]]) -> None:
-            logger.info("Updating context files from result")
-            if isinstance(result, Node):
-                ctx.files.update(agg_node_files(result))
-            elif isinstance(result, dict):
-                for key, node in result.items():
-                    ctx.files.update(agg_node_files(node))
-
         async def set_error(ctx: ApplicationContext, error: Exception) -> None:
             """Set error in context"""
             # Use logger.exception to include traceback
@@ -139,32 +201,29 @@ class FSMApplication:
 
         llm = get_best_coding_llm_client()
         vlm = get_vision_llm_client()
-        model_params = settings or {}
+        settings = settings or {}
+        event_callback = settings.get("event_callback")
+        model_params = {k: v for k, v in settings.items() if k != "event_callback"}
         workspace = await Workspace.create(
             client=client,
             base_image="oven/bun:1.2.5-alpine",
-            context=client.host().directory("./trpc_agent/template"),
+            context=_template_directory(client),
             setup_cmd=[["bun", "install"]],
         )
 
-        if settings and "event_callback" in settings:
-            event_callback = settings.pop("event_callback")
-        else:
-            event_callback = None
-        model_params = settings or {}
-
-        draft_actor = DraftActor(llm, workspace.clone(), model_params, event_callback=event_callback)
+        # actors clone the base workspace before mutating it, so a single instance is shared
+        draft_actor = DraftActor(llm, workspace, model_params, event_callback=event_callback)
         application_actor = ConcurrentActor(
-            handlers=HandlersActor(llm, workspace.clone(), model_params, beam_width=3, event_callback=event_callback),
-            frontend=FrontendActor(llm, vlm, workspace.clone(), model_params, beam_width=1, max_depth=20, event_callback=event_callback)
+            handlers=HandlersActor(llm, workspace, model_params, beam_width=3, event_callback=event_callback),
+            frontend=FrontendActor(llm, vlm, workspace, model_params, beam_width=1, max_depth=20, event_callback=event_callback)
         )
-        edit_actor = EditActor(llm, vlm, workspace.clone(), event_callback=event_callback)
+        edit_actor = EditActor(llm, vlm, workspace, event_callback=event_callback)
 
         # Define state machine states
         states = State[ApplicationContext, FSMEvent](
             on={
-                FSMEvent("CONFIRM"): FSMState.DRAFT,
-                FSMEvent("FEEDBACK"): FSMState.APPLY_FEEDBACK,
+                _CONFIRM_EVENT: FSMState.DRAFT,
+                _FEEDBACK_EVENT: FSMState.APPLY_FEEDBACK,
             },
             states={
                 FSMState.DRAFT: State(
@@ -173,7 +232,7 @@ class FSMApplication:
                         "input_fn": lambda ctx: (ctx.feedback_data or ctx.user_prompt,),
                         "on_done": {
                             "target": FSMState.REVIEW_DRAFT,
-                            "actions": [update_node_files],
+                            "actions": [_update_node_files],
                         },
                         "on_error": {
                             "target": FSMState.FAILURE,
@@ -183,8 +242,8 @@ class FSMApplication:
                 ),
                 FSMState.REVIEW_DRAFT: State(
                     on={
-                        FSMEvent("CONFIRM"): FSMState.APPLICATION,
-                        FSMEvent("FEEDBACK"): FSMState.DRAFT,
+                        _CONFIRM_EVENT: FSMState.APPLICATION,
+                        _FEEDBACK_EVENT: FSMState.DRAFT,
                     },
                 ),
                 FSMState.APPLICATION: State(
@@ -193,7 +252,7 @@ class FSMApplication:
                         "input_fn": lambda ctx: (ctx.user_prompt, ctx.files, ctx.feedback_data),
                         "on_done": {
                             "target": FSMState.REVIEW_APPLICATION,
-                            "actions": [update_node_files],
+                            "actions": [_update_node_files],
                         },
                         "on_error": {
                             "target": FSMState.FAILURE,
@@ -203,8 +262,8 @@ class FSMApplication:
                 ),
                 FSMState.REVIEW_APPLICATION: State(
                     on={
-                        FSMEvent("CONFIRM"): FSMState.COMPLETE,
-                        FSMEvent("FEEDBACK"): FSMState.APPLY_FEEDBACK,
+                        _CONFIRM_EVENT: FSMState.COMPLETE,
+                        _FEEDBACK_EVENT: FSMState.APPLY_FEEDBACK,
                     },
                 ),
                 FSMState.APPLY_FEEDBACK: State(
@@ -213,7 +272,7 @@ class FSMApplication:
                         "input_fn": lambda ctx: (ctx.files, ctx.user_prompt, ctx.feedback_data),
                         "on_done": {
                             "target": FSMState.COMPLETE,
-                            "actions": [update_node_files]
+                            "actions": [_update_node_files]
                         },
                         "on_error": {
                             "target": FSMState.FAILURE,
@@ -229,19 +288,25 @@ class FSMApplication:
         return states
 
     async def confirm_state(self):
-        await self.fsm.send(FSMEvent("CONFIRM"))
+        await self.fsm.send(_CONFIRM_EVENT)
 
     async def apply_changes(self, feedback: str):
         self.fsm.context.feedback_data = feedback
-        await self.fsm.send(FSMEvent("FEEDBACK"))
+        await self.fsm.send(_FEEDBACK_EVENT)
 
     async def complete_fsm(self):
-        while (self.current_state not in (FSMState.COMPLETE, FSMState.FAILURE)):
-            await self.fsm.send(FSMEvent("CONFIRM"))
+        fsm = self.fsm
+        send = fsm.send
+        while True:
+            stack_path = fsm.stack_path
+            state = stack_path[-1] if stack_path else ""
+            if state in _TERMINAL_STATES:
+                break
+            await send(_CONFIRM_EVENT)
 
     @property
     def is_completed(self) -> bool:
-        return self.current_state == FSMState.COMPLETE or self.current_state == FSMState.FAILURE
+        return self.current_state in _TERMINAL_STATES
 
     def maybe_error(self) -> str | None:
         return self.fsm.context.error
@@ -254,7 +319,13 @@ class FSMApplication:
 
     @property
     def truncated_files(self) -> dict[str, str]:
-        return {k: "large file truncated" if len(v) > 256 else v for k, v in self.fsm.context.files.items()}
+        files = self.fsm.context.files
+        cached = self._truncated_files_cache
+        if cached is not None and cached[0] is files:
+            return cached[1]
+        result = {k: v if len(v) <= 256 else "large file truncated" for k, v in files.items()}
+        self._truncated_files_cache = (files, result)
+        return result
 
     @property
     def state_output(self) -> dict:
@@ -292,14 +363,35 @@ class FSMApplication:
                 logger.debug(f"FSM is in processing state: {self.current_state}, offering wait action")
         return actions
 
+    @retry_transport_errors
+    async def _upload_host_directory(self, path: str) -> dagger.Directory:
+        return await self.client.host().directory(path).sync()
+
+    async def _files_directories(self, *layers: dict[str, str]) -> list[dagger.Directory]:
+        """Materialize file maps with a single host upload, returning one Dagger directory per map"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for idx, files in enumerate(layers):
+                # one worker thread per layer, a hop per file costs more than the small writes
+                await anyio.to_thread.run_sync(_write_files, os.path.join(tmp_dir, str(idx)), files)
+            # sync uploads the directory to the engine before the local copy is removed
+            uploaded = await self._upload_host_directory(tmp_dir)
+            return [uploaded.directory(str(idx)) for idx in range(len(layers))]
+        finally:
+            # removing a large tree blocks, so do it off the event loop; shielded because
+            # to_thread checkpoints first and would otherwise skip the cleanup when cancelled
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(shutil.rmtree, tmp_dir, True)
+
     async def get_diff_with(self, snapshot: dict[str, str]) -> str:
-        logger.info(f"SERVER get_diff_with: Received snapshot with {len(snapshot)} files.")
+        logger.info("SERVER get_diff_with: Received snapshot with %d files.", len(snapshot))
         if snapshot:
-            # Sort keys for consistent sample logging, especially in tests
-            sorted_snapshot_keys = sorted(snapshot.keys())
-            logger.info(f"SERVER get_diff_with: Snapshot sample paths (up to 5): {sorted_snapshot_keys[:5]}")
-            if len(snapshot) > 5:
-                logger.debug(f"SERVER get_diff_with: All snapshot paths: {sorted_snapshot_keys}")
+            if logger.isEnabledFor(logging.INFO):
+                # Sort keys for consistent sample logging, especially in tests
+                sorted_snapshot_keys = sorted(snapshot.keys())
+                logger.info("SERVER get_diff_with: Snapshot sample paths (up to 5): %s", sorted_snapshot_keys[:5])
+                if len(snapshot) > 5:
+                    logger.debug("SERVER get_diff_with: All snapshot paths: %s", sorted_snapshot_keys)
             # Log content of a very small, specific file if it exists, for deep debugging
             # Example: if "client/src/App.tsx" in snapshot:
             #    logger.debug(f"SERVER get_diff_with: Content of snapshot file 'client/src/App.tsx':\n{snapshot['client/src/App.tsx'][:200]}...")
@@ -309,47 +401,44 @@ class FSMApplication:
         logger.debug("SERVER get_diff_with: Initializing Dagger context from empty directory")
         context = self.client.directory()
 
-        gitignore_path = "./trpc_agent/template/.gitignore"
+        gitignore_path = f"{self.template_path()}/.gitignore"
         try:
-            gitignore_file = self.client.host().file(gitignore_path)
-            context = context.with_file(".gitignore", gitignore_file)
-            logger.info(f"SERVER get_diff_with: Added .gitignore from {gitignore_path} to Dagger context.")
+            if self._gitignore_file is None:
+                self._gitignore_file = self.client.host().file(gitignore_path)
+            context = context.with_file(".gitignore", self._gitignore_file)
+            logger.info("SERVER get_diff_with: Added .gitignore from %s to Dagger context.", gitignore_path)
         except Exception as e:
-            logger.warning(f"SERVER get_diff_with: Could not load/add .gitignore from {gitignore_path}: {e}. Proceeding without.")
+            logger.warning("SERVER get_diff_with: Could not load/add .gitignore from %s: %s. Proceeding without.", gitignore_path, e)
 
-        logger.info(f"SERVER get_diff_with: Writing {len(snapshot)} files from received snapshot to Dagger context.")
-        for key, value in snapshot.items():
-            logger.debug(f"SERVER get_diff_with:  Adding snapshot file to Dagger context: {key}")
-            context = context.with_new_file(key, value)
+        fsm_files = self.fsm.context.files
+        logger.info("SERVER get_diff_with: Uploading %d snapshot files and %d FSM context files to Dagger.", len(snapshot), len(fsm_files))
+        if fsm_files and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("SERVER get_diff_with: FSM files (sample): %s", list(fsm_files)[:5])
+        try:
+            snapshot_dir, fsm_dir = await self._files_directories(snapshot, fsm_files)
+        except Exception as e:
+            logger.exception("SERVER get_diff_with: Error uploading snapshot and FSM files.")
+            return f"# ERROR GENERATING DIFF: {e}"
+        context = context.with_directory(".", snapshot_dir)
 
         logger.info("SERVER get_diff_with: Creating Dagger workspace for diff generation.")
         workspace = await Workspace.create(self.client, base_image="alpine/git", context=context)
         logger.debug("SERVER get_diff_with: Dagger workspace created with initial snapshot context.")
 
-        template_dir_path = "./trpc_agent/template"
+        # the diff only depends on the net result, so template and FSM files go on as one overlay
+        template_dir_path = self.template_path()
         try:
-            template_dir = self.client.host().directory(template_dir_path)
-            workspace.ctr = workspace.ctr.with_directory(".", template_dir)
-            logger.info(f"SERVER get_diff_with: Template directory {template_dir_path} merged into Dagger workspace root.")
+            overlay = _template_directory(self.client).with_directory(".", fsm_dir)
+            workspace.ctr = workspace.ctr.with_directory(".", overlay)
+            logger.info("SERVER get_diff_with: Template directory %s and FSM files merged into Dagger workspace root.", template_dir_path)
         except Exception as e:
-            logger.error(f"SERVER get_diff_with: FAILED to merge template directory {template_dir_path} into workspace: {e}")
-
-        fsm_files_count = len(self.fsm.context.files)
-        logger.info(f"SERVER get_diff_with: Writing {fsm_files_count} files from FSM context to Dagger workspace (overlaying snapshot & template).")
-        if fsm_files_count > 0:
-             logger.debug(f"SERVER get_diff_with: FSM files (sample): {list(self.fsm.context.files.keys())[:5]}")
-        for key, value in self.fsm.context.files.items():
-            logger.debug(f"SERVER get_diff_with:  Writing FSM file to Dagger workspace: {key} (Length: {len(value)})")
-            try:
-                workspace.write_file(key, value)
-            except Exception as e:
-                logger.error(f"SERVER get_diff_with: FAILED to write FSM file {key} to workspace: {e}")
+            logger.error("SERVER get_diff_with: FAILED to merge template directory %s and FSM files into workspace: %s", template_dir_path, e)
 
         logger.info("SERVER get_diff_with: Calling workspace.diff() to generate final diff.")
         final_diff_output = ""
         try:
             final_diff_output = await workspace.diff()
-            logger.info(f"SERVER get_diff_with: workspace.diff() Succeeded. Diff length: {len(final_diff_output)}")
+            logger.info("SERVER get_diff_with: workspace.diff() Succeeded. Diff length: %d", len(final_diff_output))
             if not final_diff_output:
                  logger.warning("SERVER get_diff_with: Diff output is EMPTY. This might be expected if states match or an issue.")
         except Exception as e:
@@ -362,9 +451,7 @@ class FSMApplication:
 async def main(user_prompt="Minimal persistent counter application"):
     async with dagger.Connection(dagger.Config(log_output=open(os.devnull, "w"))) as client:
         fsm_app: FSMApplication = await FSMApplication.start_fsm(client, user_prompt)
-
-        while (fsm_app.current_state not in (FSMState.COMPLETE, FSMState.FAILURE)):
-            await fsm_app.fsm.send(FSMEvent("CONFIRM"))
+        await fsm_app.complete_fsm()
 
         context = fsm_app.fsm.context
         if fsm_app.maybe_error():
@@ -382,4 +469,4 @@ async def main(user_prompt="Minimal persistent counter application"):
 
 
 if __name__ == "__main__":
-    anyio.run(main)
+    anyio.run(main, backend="asyncio", backend_options={"use_uvloop": sys.platform != "win32"})